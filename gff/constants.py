@@ -12,10 +12,12 @@ WORLDCOVER_PW_CLASS = 80
 # For some reason PACKBITS wasn't compressing very well.
 # Disk size scaled by regions of nodata.
 # Back to DEFLATE :shrug:
+# Now ZSTD, which is both smaller and faster to read/write than DEFLATE for uint8 classes.
 FLOODMAP_PROFILE_DEFAULTS = {
-    "COMPRESS": "DEFLATE",
-    "ZLEVEL": 1,
+    "COMPRESS": "ZSTD",
+    "ZSTD_LEVEL": 9,
     "PREDICTOR": 2,
+    "NUM_THREADS": "ALL_CPUS",
     "count": 1,
     "dtype": np.uint8,
     "nodata": 255,
@@ -11,6 +11,7 @@ import subprocess
 import time
 import urllib
 import tarfile
+import threading
 import zipfile
 
 import asf_search as asf
@@ -197,13 +198,27 @@ def get_nbyn_product(shp, shp_crs, folder, getter, n=1, preprocess=None, **kwarg
     xlo, ylo, xhi, yhi = shp4326.bounds
     ew_ran = range(math.floor(xlo / n) * n, math.ceil(xhi / n) * n, n)
     ns_ran = range(math.floor(ylo / n) * n, math.ceil(yhi / n) * n, n)
-    paths = [getter(ns, ew, folder, **kwargs) for ew, ns in itertools.product(ew_ran, ns_ran)]
-    dem = xarray.open_mfdataset(paths, preprocess=preprocess)
+    # Floodmaps load tiles from more than one thread, which could download the same file at once
+    with _nbyn_lock:
+        paths = [getter(ns, ew, folder, **kwargs) for ew, ns in itertools.product(ew_ran, ns_ran)]
+        dem = _open_nbyn_dataset(tuple(paths), preprocess)
     box = dem.sel(x=slice(xlo, xhi), y=slice(yhi, ylo))
 
     return box.compute()
 
 
+_nbyn_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=64)
+def _open_nbyn_dataset(paths: tuple[Path], preprocess: callable = None):
+    """
+    Lazily opened, so only the selected box is read from disk each time.
+    Cached since neighbouring shapes usually fall in the same product tiles.
+    """
+    return xarray.open_mfdataset(paths, preprocess=preprocess)
+
+
 def get_world_cover(shp, shp_crs, folder):
     return get_nbyn_product(shp, shp_crs, folder, get_world_cover_file, n=3)
 
@@ -246,7 +261,17 @@ def download_s1(img_folder, asf_result, cred_fname=".asf_auth"):
     return zip_fpath
 
 
+# Only one SNAP run at a time. They share the DEM/orbit auxdata folders, which SNAP downloads
+# into as needed, and each needs a 12G JVM heap.
+_snap_lock = threading.Lock()
+
+
 def preprocess_s1(data_folder: Path, s1_fname: Path, out_fname: Path):
+    with _snap_lock:
+        _preprocess_s1(data_folder, s1_fname, out_fname)
+
+
+def _preprocess_s1(data_folder: Path, s1_fname: Path, out_fname: Path):
     img_folder = data_folder / "s1"
     assert (img_folder / s1_fname).exists(), "Sentinel 1 file not downloaded"
     if (img_folder / "tmp" / out_fname).exists():
@@ -259,7 +284,7 @@ def preprocess_s1(data_folder: Path, s1_fname: Path, out_fname: Path):
             "docker",
             "run",
             "--rm",
-            "-it",
+            "-i",
             "-v",
             f"{str(data_folder)}/dem:/root/.snap/auxdata/dem",
             "-v",
@@ -483,6 +508,13 @@ def get_climate_zone(tif: rasterio.DatasetReader, geom: shapely.Geometry, geom_c
 
 
 def ks_water_stats(tile: np.ndarray):
+    if np.issubdtype(tile.dtype, np.unsignedinteger):
+        # Count all classes (and nodata) in a single pass
+        counts = np.bincount(tile.ravel(), minlength=3)
+        bg = counts[constants.KUROSIWO_BG_CLASS]
+        pwater = counts[constants.KUROSIWO_PW_CLASS]
+        flood = counts[constants.KUROSIWO_FLOOD_CLASS]
+        return bg, pwater, flood
     flood = tile == constants.KUROSIWO_FLOOD_CLASS
     pwater = tile == constants.KUROSIWO_PW_CLASS
     bg = tile == constants.KUROSIWO_BG_CLASS
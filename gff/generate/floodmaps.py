@@ -1,3 +1,5 @@
+import collections
+import concurrent.futures
 import datetime
 import functools
 import itertools
@@ -8,7 +10,6 @@ from pathlib import Path
 import shutil
 import subprocess
 import traceback
-from typing import Union
 import warnings
 
 import affine
@@ -16,6 +17,7 @@ import geopandas
 import numpy as np
 import pandas as pd
 import rasterio
+import rasterio.shutil
 import scipy
 import shapely
 import skimage
@@ -28,12 +30,8 @@ import gff.generate.util
 
 
 def check_tifs_match(tifs):
-    transforms = [tif.transform for tif in tifs]
-    t0 = transforms[0]
-    res = t0[0], t0[4]
-    assert all(
-        [np.allclose((t[0], t[4]), res) for t in transforms[1:]]
-    ), "Not all tifs have same resolution"
+    res = np.array([(tif.transform[0], tif.transform[4]) for tif in tifs])
+    assert np.allclose(res, res[0]), "Not all tifs have same resolution"
     assert all([tif.crs == tifs[0].crs for tif in tifs[1:]]), "Not all tifs have the same CRS"
 
 
@@ -46,7 +44,8 @@ def ensure_s1(data_folder, prefix, results, delete_intermediate=False):
     if out_fpath.exists():
         return out_fpath
 
-    zip_fpaths, processed_fpaths = [], []
+    tmp_folder = img_folder / "tmp"
+    zip_fpaths, dim_data_paths, vrt_fpaths = [], [], []
     for result in results:
         # Download image
         zip_fpath = data_sources.download_s1(img_folder, result)
@@ -57,41 +56,62 @@ def ensure_s1(data_folder, prefix, results, delete_intermediate=False):
         data_sources.preprocess_s1(data_folder, zip_fpath.name, dim_fname)
         # DIMAP is a weird format. You ask it to save at ".dim" and it actually saves elsewhere
         # Anyway, need to combine the vv and vh bands into a single file for later merge
-        dim_data_path = img_folder / "tmp" / dim_fname.with_suffix(".data")
-        processed_fpath = img_folder / dim_fname.with_suffix(".tif")
-        processed_fpaths.append(processed_fpath)
-        if not processed_fpath.exists():
-            print("Merging DIMAP to a single TIF.")
+        # This is just a VRT, so the pixels aren't read until the final gdal_translate
+        dim_data_path = tmp_folder / dim_fname.with_suffix(".data")
+        dim_data_paths.append(dim_data_path)
+        vrt_fpath = tmp_folder / dim_fname.with_suffix(".vrt")
+        vrt_fpaths.append(vrt_fpath)
+        if not vrt_fpath.exists():
+            print("Stacking DIMAP bands into a single VRT.")
             subprocess.run(
                 [
-                    "gdal_merge.py",
+                    "gdalbuildvrt",
                     "-separate",
-                    "-o",
-                    processed_fpath,
+                    vrt_fpath,
                     dim_data_path / "Sigma0_VV.img",
                     dim_data_path / "Sigma0_VH.img",
                 ]
             )
-            if delete_intermediate:
-                shutil.rmtree(dim_data_path)
-                dim_data_path.with_suffix(".dim").unlink()
 
-    if len(processed_fpaths) > 1:
-        print("Merging multiple captures from the same day into a single tif")
-        subprocess.run(["gdal_merge.py", "-n", "0", "-o", out_fpath, *processed_fpaths])
+    if len(vrt_fpaths) > 1:
+        print("Merging multiple captures from the same day into a single VRT")
+        # Like gdal_merge.py -n 0; later captures are pasted over earlier ones, ignoring 0s
+        day_vrt_fpath = tmp_folder / Path(filename).with_suffix(".vrt")
+        nodata_args = ["-srcnodata", "0", "-hidenodata"]
+        subprocess.run(["gdalbuildvrt", *nodata_args, day_vrt_fpath, *vrt_fpaths])
+        vrt_fpaths.append(day_vrt_fpath)
     else:
-        shutil.copy(processed_fpaths[0], out_fpath)
+        day_vrt_fpath = vrt_fpaths[0]
 
-    print("Compressing result")
-    tmp_compress_path = img_folder / "tmp" / filename
+    print("Merging and compressing result")
+    tmp_compress_path = tmp_folder / filename
+    config_args = ["--config", "GDAL_CACHEMAX", "2048"]
     compress_args = ["-co", "COMPRESS=LERC", "-co", "MAX_Z_ERROR=0.0001"]
-    util_args = ["-co", "BIGTIFF=YES", "-co", "INTERLEAVE=BAND"]
-    subprocess.run(["gdal_translate", *compress_args, *util_args, out_fpath, tmp_compress_path])
+    util_args = ["-co", "BIGTIFF=YES", "-co", "INTERLEAVE=BAND", "-co", "NUM_THREADS=ALL_CPUS"]
+    # Tiled with blocks the size of a model tile, so reading a tile decompresses at most 4 blocks
+    block_size = constants.FLOODMAP_BLOCK_SIZE
+    block_args = ["-co", "TILED=YES", "-co", f"BLOCKXSIZE={block_size}"]
+    block_args += ["-co", f"BLOCKYSIZE={block_size}"]
+    subprocess.run(
+        [
+            "gdal_translate",
+            *config_args,
+            *compress_args,
+            *util_args,
+            *block_args,
+            day_vrt_fpath,
+            tmp_compress_path,
+        ]
+    )
+    # Only move into place once complete, since existence of out_fpath means it's done
     shutil.move(tmp_compress_path, out_fpath)
 
     if delete_intermediate:
-        for p in processed_fpaths:
+        for p in vrt_fpaths:
             p.unlink()
+        for dim_data_path in dim_data_paths:
+            shutil.rmtree(dim_data_path)
+            dim_data_path.with_suffix(".dim").unlink()
     return out_fpath
 
 
@@ -126,6 +146,11 @@ def floodmap_tiles_from_meta(meta_path: Path):
     return np.array(visit_tiles.geometry)
 
 
+# Downloading S1 is spent waiting on the network, so threads are enough to download each image
+# in a tuplet at the same time. Note: data_sources.preprocess_s1 only runs one SNAP at a time.
+s1_pool = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+
+
 def create_flood_maps(
     data_folder,
     search_results,
@@ -166,13 +191,15 @@ def create_flood_maps(
     for map_idx, search_idx in enumerate(search_idxs):
         results_group = [search_results[i] for i in search_idx]
 
-        s1_img_paths = []
+        # Get images (concurrently)
+        futs = [
+            s1_pool.submit(ensure_s1, data_folder, cross_term, res, delete_intermediate=True)
+            for res in results_group
+        ]
+        s1_img_paths = [fut.result() for fut in futs]
+        # Get image dates
         date_strs = []
         for res in results_group:
-            # Get image
-            img_path = ensure_s1(data_folder, cross_term, res, delete_intermediate=True)
-            s1_img_paths.append(img_path)
-            # Get image date
             res_date = datetime.datetime.fromisoformat(res[0]["properties"]["startTime"])
             date_strs.append(res_date.strftime("%Y-%m-%d"))
 
@@ -255,18 +282,22 @@ def progressively_grow_floodmaps(
     rivers_df: geopandas.GeoDataFrame,
     data_folder: Path,
     floodmap_path: Path,
-    flood_model: Union[torch.nn.Module, callable],
+    flood_model: "FloodModelRunner",
     tile_size: int = 224,
     export_s1: bool = False,
     print_freq: int = 0,
     viable_footprint: shapely.Geometry = None,
     max_tiles: int = 2500,
     prescribed_tiles: np.ndarray[shapely.Geometry] = None,
+    batch_size: int = 16,
 ):
     """
     First runs flood_model along riverways, then expands the search as flooded areas are found.
     Stores all visited tiles to floodmap_path.
 
+    The flood_model is run on batches of up to batch_size tiles at a time, and the inputs for
+    the next batch are loaded while the current batch is running.
+
     Note: all tifs in inp_img_paths must match resolution and CRS.
     Thus the output is in the same CRS.
 
@@ -277,10 +308,18 @@ def progressively_grow_floodmaps(
     inp_tifs = [rasterio.open(p) for p in inp_img_paths]
     ref_tif = inp_tifs[-1]
     check_tifs_match(inp_tifs)
+    # The next batch's inputs (of centre or adjacent tiles) are loaded in a separate thread while
+    # the model runs on this one.
+    # Rasterio datasets can't be shared between threads, so that thread gets its own.
+    prefetch_tifs = [rasterio.open(p) for p in inp_img_paths]
+    prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
     # Create tile_grid and initial set of tiles
     tile_grids, footprint_box = mk_grid(viable_footprint, ref_tif.transform, tile_size)
     grid_size = tile_grids[(0, 0)].shape
+    # Only tiles entirely within the footprint are run, checked for the whole grid at once
+    shapely.prepare(viable_footprint)
+    contains_mask = shapely.contains(viable_footprint, tile_grids[(0, 0)])
     if prescribed_tiles is None:
         tiles = create_initial_tiles(
             rivers_df,
@@ -294,124 +333,199 @@ def progressively_grow_floodmaps(
         tiles = get_grid_idx(tile_grids[(0, 0)], prescribed_tiles)
 
     visited = np.zeros_like(tile_grids[(0, 0)]).astype(bool)
+    # Every tile that has ever been added to tiles (which includes all visited tiles)
+    queued = np.zeros_like(visited)
+    for tile in tiles:
+        queued[tile] = True
+    tiles = collections.deque(tiles)
     offset_cache = {(0, 1): {}, (1, 0): {}, (1, 1): {}}
+    # Visited tiles that no longer need the offset_cache (visited includes the prefetched batch)
+    done = np.zeros_like(visited)
 
     # Rasterio profile handling
+    # The output starts at the first tile, so with blocks the size of a tile,
+    # each tile is written to exactly one block.
     outxlo, _, _, outyhi = footprint_box.bounds
     t = ref_tif.transform
     new_transform = rasterio.transform.from_origin(outxlo, outyhi, t[0], -t[4])
     floodmap_nodata = 255
-    profile = {
+    # Shared by both the floodmap and s1 profiles
+    base_profile = {
         **ref_tif.profile,
+        "transform": new_transform,
+        "width": grid_size[0] * tile_size,
+        "height": grid_size[1] * tile_size,
+    }
+    tile_profile = {"blockxsize": tile_size, "blockysize": tile_size}
+    profile = {
+        **base_profile,
         **constants.FLOODMAP_PROFILE_DEFAULTS,
+        **tile_profile,
         "nodata": floodmap_nodata,
-        "transform": new_transform,
-        "width": tile_grids[0, 0].shape[0] * tile_size,
-        "height": tile_grids[0, 0].shape[1] * tile_size,
         "BIGTIFF": "IF_NEEDED",
     }
-    s1_fpaths = None
-    s1_tifs = None
-    if export_s1:
-        s1_profile = {
-            **ref_tif.profile,
-            **constants.S1_PROFILE_DEFAULTS,
-            "transform": new_transform,
-            "width": tile_grids[0, 0].shape[0] * tile_size,
-            "height": tile_grids[0, 0].shape[1] * tile_size,
-            "BIGTIFF": "YES",
-        }
-        s1_folder = data_folder / "s1-export"
-        s1_folder.mkdir(exist_ok=True)
-        s1_tifs = []
-        s1_fpaths = []
-        for name in constants.KUROSIWO_S1_NAMES[-(len(inp_img_paths)) :]:
-            s1_fpath = s1_folder / f"{floodmap_path.stem}_{name}.tif"
-            s1_fpaths.append(s1_fpath)
-            if s1_fpath.exists():
-                s1_tifs.append(rasterio.open(s1_fpath, "r+"))
-            else:
-                s1_tifs.append(rasterio.open(s1_fpath, "w", **s1_profile))
-
-    # Begin flood-fill search
-    visit_tiles, fill_tiles = [], []
-    geom_stats = []
-    raw_floodmap_path = floodmap_path.with_stem(floodmap_path.stem + "-raw")
-    with rasterio.open(raw_floodmap_path, "w", **profile) as out_tif:
-        n_visited = 0
-        n_flooded = 0
-        n_permanent = 0
-        n_outside = 0
-        while len(tiles) > 0 and len(visit_tiles) < max_tiles:
-            # Grab a tile and get logits
-            tile_x, tile_y = tiles.pop(0)
-            visited[tile_x, tile_y] = True
-            n_visited += 1
-            tile_geom = tile_grids[(0, 0)][tile_x, tile_y]
-            visit_tiles.append(tile_geom)
-            if not shapely.contains(viable_footprint, tile_geom):
-                n_outside += 1
-                continue
-            s1_inps, dem, flood_logits = flood_model(inp_tifs, tile_geom)
-            s1_inps = [t[0].cpu().numpy() for t in s1_inps]
-            if not s1_preprocess_edge_heuristic(s1_inps) or flood_logits is None:
-                n_outside += 1
-                continue
+    # Tiles are written one block at a time, and kept in the GDAL block cache until closed.
+    # Input blocks are decompressed with multiple threads, and opening the outputs doesn't list
+    # their (large) folders, since there are no sidecar files to look for
+    with rasterio.Env(
+        GDAL_CACHEMAX=2048, GDAL_NUM_THREADS="ALL_CPUS", GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR"
+    ):
+        s1_fpaths = None
+        s1_tifs = None
+        if export_s1:
+            s1_profile = {
+                **base_profile,
+                **constants.S1_PROFILE_DEFAULTS,
+                **tile_profile,
+                "BIGTIFF": "YES",
+            }
+            s1_folder = data_folder / "s1-export"
+            s1_folder.mkdir(exist_ok=True)
+            s1_tifs = []
+            s1_fpaths = []
+            for name in constants.KUROSIWO_S1_NAMES[-(len(inp_img_paths)) :]:
+                s1_fpath = s1_folder / f"{floodmap_path.stem}_{name}.tif"
+                s1_fpaths.append(s1_fpath)
+                if s1_fpath.exists():
+                    s1_tifs.append(rasterio.open(s1_fpath, "r+"))
+                else:
+                    s1_tifs.append(rasterio.open(s1_fpath, "w", **s1_profile))
+
+        # Begin flood-fill search
+        visit_tiles, fill_tiles = [], []
+        geom_stats = []
+        raw_floodmap_path = floodmap_path.with_stem(floodmap_path.stem + "-raw")
+        with rasterio.open(raw_floodmap_path, "w", **profile) as out_tif:
+            out_transform = out_tif.transform
+            bounds_to_window = util.shapely_bounds_to_rasterio_window
+            n_visited = 0
+            n_flooded = 0
+            n_permanent = 0
+            n_outside = 0
+
+            def pop_batch():
+                # Pops tiles from the front of the queue until there's a batch inside the footprint
+                nonlocal n_visited, n_outside
+                batch_idxs = []
+                while (
+                    len(tiles) > 0 and len(batch_idxs) < batch_size and len(visit_tiles) < max_tiles
+                ):
+                    tile_x, tile_y = tiles.popleft()
+                    visited[tile_x, tile_y] = True
+                    n_visited += 1
+                    tile_geom = tile_grids[(0, 0)][tile_x, tile_y]
+                    visit_tiles.append(tile_geom)
+                    if not contains_mask[tile_x, tile_y]:
+                        done[tile_x, tile_y] = True
+                        n_outside += 1
+                        continue
+                    batch_idxs.append((tile_x, tile_y))
+                return batch_idxs
+
+            def prefetch_batch():
+                # Starts loading the inputs for the next batch in the background
+                batch_idxs = pop_batch()
+                if len(batch_idxs) == 0:
+                    return batch_idxs, None
+                batch_geoms = [tile_grids[(0, 0)][tile_idx] for tile_idx in batch_idxs]
+                return batch_idxs, prefetch_pool.submit(
+                    flood_model.load, prefetch_tifs, batch_geoms
+                )
 
-            # Smooth logits out over adjacent tiles
-            adjacent_logits = get_adjacent_logits(
-                inp_tifs, tile_grids, tile_x, tile_y, flood_model, offset_cache
-            )
-            flood_logits = average_logits_towards_edges(flood_logits, adjacent_logits)
-
-            # Write classes to disk
-            flood_cls = flood_logits.argmax(axis=0)[None].astype(np.uint8)
-            window = util.shapely_bounds_to_rasterio_window(tile_geom.bounds, out_tif.transform)
-            if export_s1:
-                for s1_tif, s1_inp_tile in zip(s1_tifs, s1_inps):
-                    s1_tif.write(s1_inp_tile, window=window)
-            out_tif.write(flood_cls, window=window)
-            fill_tiles.append(tile_geom)
-            stats = data_sources.ks_water_stats(flood_cls)
-            geom_stats.append(stats)
-
-            # Select new potential tiles (if not visited)
-            if ((flood_cls == constants.KUROSIWO_PW_CLASS).mean() > 0.5) or (
-                (flood_cls == constants.KUROSIWO_BG_CLASS).mean() < 0.1
-            ):
-                # Don't go into the ocean or large lakes
-                n_permanent += 1
-            elif tile_flooded(stats):
-                n_flooded += 1
-                new_tiles = sel_new_tiles_big_window(tile_x, tile_y, *grid_size, add=3)
-                for tile in new_tiles:
-                    if not visited[tile] and (tile not in tiles):
-                        tiles.append(tile)
-
-            # Logging
-            if print_freq > 0 and n_visited % print_freq == 0 or len(tiles) == 0:
-                print(
-                    f"{len(tiles):6d} open",
-                    f"{n_visited:6d} visited",
-                    f"{n_flooded:6d} flooded",
-                    f"{n_permanent:6d} in large bodies of water",
-                    f"{n_outside:6d} outside legal bounds",
+            next_batch = None
+            while next_batch is not None or (len(tiles) > 0 and len(visit_tiles) < max_tiles):
+                n_visited_start = n_visited
+                batch_idxs, batch_inputs = (
+                    next_batch if next_batch is not None else prefetch_batch()
                 )
-        print(
-            f"{len(tiles):6d} open",
-            f"{n_visited:6d} visited",
-            f"{n_flooded:6d} flooded",
-            f"{n_permanent:6d} in large bodies of water",
-            f"{n_outside:6d} outside legal bounds",
-        )
-    if export_s1:
-        for s1_tif in s1_tifs:
-            s1_tif.close()
-    for tif in inp_tifs:
-        tif.close()
+                # Only prefetch when the queue already holds a whole next batch, so it mostly doesn't
+                # matter that tiles from this batch haven't been queued yet. Except that queued
+                # tiles outside the footprint are skipped, so the prefetched batch can come up
+                # short, where it would otherwise have been topped up with this batch's tiles.
+                next_batch = None
+                if len(tiles) >= batch_size and len(visit_tiles) < max_tiles:
+                    next_batch = prefetch_batch()
+                if len(batch_idxs) == 0:
+                    continue
+
+                # Get logits for the whole batch at once
+                batch_s1_inps, _, batch_logits = flood_model.infer(*batch_inputs.result())
+                ready = []
+                for i, (tile_idx, flood_logits) in enumerate(zip(batch_idxs, batch_logits)):
+                    s1_inps = [t[i] for t in batch_s1_inps]
+                    if not s1_preprocess_edge_heuristic(s1_inps) or flood_logits is None:
+                        n_outside += 1
+                        continue
+                    ready.append((tile_idx, s1_inps, flood_logits))
+
+                # Smooth logits out over adjacent tiles
+                ensure_adjacent_logits(
+                    prefetch_tifs,
+                    tile_grids,
+                    [tile_idx for tile_idx, _, _ in ready],
+                    flood_model,
+                    offset_cache,
+                    prefetch_pool,
+                    batch_size,
+                )
+                for (tile_x, tile_y), s1_inps, flood_logits in ready:
+                    tile_geom = tile_grids[(0, 0)][tile_x, tile_y]
+                    adjacent_logits = get_adjacent_logits(tile_x, tile_y, offset_cache)
+                    flood_logits = average_logits_towards_edges(flood_logits, adjacent_logits)
+
+                    # Write classes to disk
+                    flood_cls = flood_logits.argmax(axis=0)[None].astype(np.uint8)
+                    window = bounds_to_window(tile_geom.bounds, out_transform)
+                    if export_s1:
+                        for s1_tif, s1_inp_tile in zip(s1_tifs, s1_inps):
+                            s1_tif.write(s1_inp_tile, window=window)
+                    out_tif.write(flood_cls, window=window)
+                    fill_tiles.append(tile_geom)
+                    stats = data_sources.ks_water_stats(flood_cls)
+                    geom_stats.append(stats)
+                    n_bg, n_pw, _ = stats
+
+                    # Select new potential tiles (if not visited)
+                    if (n_pw / flood_cls.size > 0.5) or (n_bg / flood_cls.size < 0.1):
+                        # Don't go into the ocean or large lakes
+                        n_permanent += 1
+                    elif tile_flooded(stats):
+                        n_flooded += 1
+                        queue_new_tiles_big_window(tile_x, tile_y, queued, tiles, add=3)
+
+                # Drop adjacent logits that won't be used again
+                for tile_idx in batch_idxs:
+                    done[tile_idx] = True
+                evict_adjacent_logits(batch_idxs, done, offset_cache)
+
+                # Logging
+                passed_print = print_freq > 0 and (n_visited // print_freq) > (
+                    n_visited_start // print_freq
+                )
+                if passed_print or len(tiles) == 0:
+                    print(
+                        f"{len(tiles):6d} open",
+                        f"{n_visited:6d} visited",
+                        f"{n_flooded:6d} flooded",
+                        f"{n_permanent:6d} in large bodies of water",
+                        f"{n_outside:6d} outside legal bounds",
+                    )
+            print(
+                f"{len(tiles):6d} open",
+                f"{n_visited:6d} visited",
+                f"{n_flooded:6d} flooded",
+                f"{n_permanent:6d} in large bodies of water",
+                f"{n_outside:6d} outside legal bounds",
+            )
+        if export_s1:
+            for s1_tif in s1_tifs:
+                s1_tif.close()
+        prefetch_pool.shutdown()
+        for tif in inp_tifs + prefetch_tifs:
+            tif.close()
 
     print(" Tile search complete. Postprocessing outputs.")
-    postprocess_classes(raw_floodmap_path, floodmap_path, floodmap_nodata)
+    postprocess_classes(raw_floodmap_path, floodmap_path)
     return fill_tiles, geom_stats, n_flooded, s1_fpaths
 
 
@@ -451,7 +565,7 @@ def major_upstream_riverways(basins_df, start, bounds, threshold=20000):
 def mk_grid(geom: shapely.Geometry, transform: affine.Affine, gridsize: int):
     """Create a grid in CRS-space where each block is `gridsize` large"""
     # Translate geom into some pixel-space coordinates
-    geom_in_px = shapely.ops.transform(lambda x, y: ~transform * (x, y), geom)
+    geom_in_px = util.convert_affine(geom, ~transform)
 
     # So that you can create a grid that is the correct size in pixel coordinates
     xlo, ylo, xhi, yhi = geom_in_px.bounds
@@ -477,34 +591,47 @@ def mk_grid(geom: shapely.Geometry, transform: affine.Affine, gridsize: int):
     grids = {k: util.convert_affine(grid, transform) for k, grid in grids.items()}
     # The geom is then aligned to the pixels in the reference tif to ensure no resampling
     new_geom = shapely.box(xlo, ylo, xhi, yhi)
-    pixel_aligned_geom = shapely.ops.transform(
-        lambda x, y: transform * np.array((x, y), dtype=np.float64), new_geom
-    )
+    pixel_aligned_geom = util.convert_affine(new_geom, transform)
 
     # Note this only works if all images these grids are applied to have the exact same resolution
     return grids, pixel_aligned_geom
 
 
+def _rivers_in_crs(rivers_df, crs):
+    crs_str = crs.to_string() if hasattr(crs, "to_string") else str(crs)
+    return _rivers_in_crs_str(rivers_df, crs_str)
+
+
+# Reprojecting all the rivers is slow, so only do it once per CRS
+@util.cache_by_id
+def _rivers_in_crs_str(rivers_df, crs_str):
+    rivers = rivers_df.to_crs(crs_str)
+    # Build the spatial index now, so it's cached alongside
+    rivers.sindex
+    return rivers
+
+
 def tiles_along_river_within_geom(
     rivers_df, geom, tile_grid, crs, min_river_size=500, max_tiles=200
 ):
     """
     Select tiles from a tile_grid where the rivers (multiple LINEs) touch a geom (a POLYGON).
     """
-    # River geoms within geom
-    rivers_df = rivers_df.to_crs(crs)
-    river = rivers_df[rivers_df.geometry.intersects(geom)]
+    # River geoms within geom (using the spatial index, which is also cached with rivers_df)
+    rivers_df = _rivers_in_crs(rivers_df, crs)
+    river_idxs = rivers_df.sindex.query(geom, predicate="intersects")
+    river = rivers_df.iloc[np.sort(river_idxs)]
+    # Filtered after the query, so only one copy of all the rivers is kept per CRS
+    river = river[river["riv_tc_usu"] > min_river_size]
     if len(river) == 0:
         return []
 
     # Combine river geoms and check for intersection with tile_grid
-    if min_river_size is not None:
-        river = river[river["riv_tc_usu"] > min_river_size]
     river = river.sort_values("riv_tc_usu")
-    intersects = shapely.union_all(river.geometry.values).intersects(tile_grid)
+    river_idxs = grid_intersecting(tile_grid, shapely.union_all(river.geometry.values))
 
     # Return the tile coordinates of intersection as a list
-    x, y = intersects.nonzero()
+    x, y = np.unravel_index(river_idxs, tile_grid.shape)
     return list(zip(x, y))[:max_tiles]
 
 
@@ -534,72 +661,115 @@ def create_initial_tiles(rivers_df, geom, tile_grid, crs, min_river_size=500, ma
         tiles = sel_new_tiles_big_window(gw // 2, gh // 2, *grid_size, add=3)
 
     # Expand a small area around the river tiles
+    queued = np.zeros(grid_size, dtype=bool)
+    for tile in tiles:
+        queued[tile] = True
     for tile_x, tile_y in tiles.copy():
-        new_tiles = sel_new_tiles_big_window(tile_x, tile_y, *grid_size, add=2)
-        for tile in new_tiles:
-            if tile not in tiles:
-                tiles.append(tile)
+        queue_new_tiles_big_window(tile_x, tile_y, queued, tiles, add=2)
     return tiles
 
 
+def grid_intersecting(grid, geom):
+    """
+    Uses a spatial index to find which cells of grid (shaped [W, H]) intersect geom.
+    Returns the flat indices into grid, (sorted, so in the same order as np.nonzero)
+    """
+    return np.sort(shapely.STRtree(grid.ravel()).query(geom, predicate="intersects"))
+
+
 def get_grid_idx(grid, tile_geoms):
     # grid shaped [W, H], tile_geoms shaped [N]
     tiles_combined = shapely.unary_union(tile_geoms)
     tile_area = grid[0, 0].area
-    tiles_incl = shapely.area(shapely.intersection(grid, tiles_combined)) > (0.01 * tile_area)
-    return list(zip(*tiles_incl.nonzero()))
-
-
-def _ensure_logits(tifs, offset_tile_grid, x, y, flood_model, offset_cache):
-    if (x, y) in offset_cache:
-        return
-    w, h = offset_tile_grid.shape
-    if x >= 0 and y >= 0 and x < w and y < h:
-        offset_tile_geom = offset_tile_grid[x, y]
-        _, _, offset_logits = flood_model(tifs, offset_tile_geom)
-        offset_cache[(x, y)] = offset_logits
-    else:
-        offset_cache[(x, y)] = None
-
-
-def get_adjacent_logits(tifs, tile_grids, tile_x, tile_y, flood_model, offset_cache):
+    # Only calculate overlap for cells that could overlap
+    cand_idxs = grid_intersecting(grid, tiles_combined)
+    cand_areas = shapely.area(shapely.intersection(grid.ravel()[cand_idxs], tiles_combined))
+    incl_idxs = cand_idxs[cand_areas > (0.01 * tile_area)]
+    return list(zip(*np.unravel_index(incl_idxs, grid.shape)))
+
+
+# Tile grid offsets are half a tile offset as compared to original grid (positive direction),
+# thus +0,+0 is positioned to the bottom/right, and -1,-1 is positioned to the top/left
+# Maps each adjacent direction to (offset grid key, x offset, y offset)
+ADJACENT_OFFSETS = {
+    "le": ((1, 0), -1, +0),
+    "ri": ((1, 0), +0, +0),
+    "up": ((0, 1), +0, -1),
+    "do": ((0, 1), +0, +0),
+    "tl": ((1, 1), -1, -1),
+    "tr": ((1, 1), +0, -1),
+    "bl": ((1, 1), -1, +0),
+    "br": ((1, 1), +0, +0),
+}
+
+
+def ensure_adjacent_logits(
+    tifs, tile_grids, tile_idxs, flood_model, offset_cache, pool, batch_size: int = 16
+):
     """
     Given a set of tile_grids which are offset from one another by half a tile,
-    run the flood model and add the tile to the offset_cache if it is not already there.
-    Then return the tiles in all 8 adjacent directions.
-    """
-
-    # Tile grid offsets are half a tile offset as compared to original grid (positive direction),
-    # thus +0,+0 is positioned to the bottom/right, and -1,-1 is positioned to the top/left
-    lr_grid = tile_grids[(1, 0)]
-    lr_cache = offset_cache[(1, 0)]
-    _ensure_logits(tifs, lr_grid, tile_x - 1, tile_y + 0, flood_model, lr_cache)
-    _ensure_logits(tifs, lr_grid, tile_x + 0, tile_y + 0, flood_model, lr_cache)
-
-    ud_grid = tile_grids[(0, 1)]
-    ud_cache = offset_cache[(0, 1)]
-    _ensure_logits(tifs, ud_grid, tile_x + 0, tile_y - 1, flood_model, ud_cache)
-    _ensure_logits(tifs, ud_grid, tile_x + 0, tile_y + 0, flood_model, ud_cache)
-
-    di_grid = tile_grids[(1, 1)]
-    di_cache = offset_cache[(1, 1)]
-    _ensure_logits(tifs, di_grid, tile_x - 1, tile_y - 1, flood_model, di_cache)
-    _ensure_logits(tifs, di_grid, tile_x + 0, tile_y - 1, flood_model, di_cache)
-    _ensure_logits(tifs, di_grid, tile_x - 1, tile_y + 0, flood_model, di_cache)
-    _ensure_logits(tifs, di_grid, tile_x + 0, tile_y + 0, flood_model, di_cache)
+    run the flood model (in batches) on all tiles adjacent to tile_idxs and add them
+    to the offset_cache if they are not already there.
 
+    Each batch's inputs are loaded in pool while the model runs on the previous batch,
+    so tifs must only be used by pool's (single) thread.
+    """
+    to_run = {}
+    for tile_x, tile_y in tile_idxs:
+        for grid_key, dx, dy in ADJACENT_OFFSETS.values():
+            x, y = tile_x + dx, tile_y + dy
+            if (x, y) in offset_cache[grid_key] or (grid_key, x, y) in to_run:
+                continue
+            w, h = tile_grids[grid_key].shape
+            if x >= 0 and y >= 0 and x < w and y < h:
+                to_run[(grid_key, x, y)] = tile_grids[grid_key][x, y]
+            else:
+                offset_cache[grid_key][(x, y)] = None
+
+    keys, geoms = list(to_run.keys()), list(to_run.values())
+    starts = list(range(0, len(keys), batch_size))
+    load = lambda i: pool.submit(flood_model.load, tifs, geoms[i : i + batch_size])
+    next_inputs = load(starts[0]) if len(starts) > 0 else None
+    for j, i in enumerate(starts):
+        batch_inputs = next_inputs
+        if j + 1 < len(starts):
+            next_inputs = load(starts[j + 1])
+        _, _, offset_logits = flood_model.infer(*batch_inputs.result())
+        for (grid_key, x, y), logits in zip(keys[i : i + batch_size], offset_logits):
+            offset_cache[grid_key][(x, y)] = logits
+
+
+def get_adjacent_logits(tile_x, tile_y, offset_cache):
+    """
+    Return the logits of the tiles in all 8 adjacent directions.
+    Assumes they have already been added to offset_cache by ensure_adjacent_logits.
+    """
     return {
-        "le": lr_cache[(tile_x - 1, tile_y + 0)],
-        "ri": lr_cache[(tile_x + 0, tile_y + 0)],
-        "up": ud_cache[(tile_x + 0, tile_y - 1)],
-        "do": ud_cache[(tile_x + 0, tile_y + 0)],
-        "tl": di_cache[(tile_x - 1, tile_y - 1)],
-        "tr": di_cache[(tile_x + 0, tile_y - 1)],
-        "bl": di_cache[(tile_x - 1, tile_y + 0)],
-        "br": di_cache[(tile_x + 0, tile_y + 0)],
+        k: offset_cache[grid_key][(tile_x + dx, tile_y + dy)]
+        for k, (grid_key, dx, dy) in ADJACENT_OFFSETS.items()
     }
 
 
+def evict_adjacent_logits(tile_idxs, done, offset_cache):
+    """
+    Remove the logits adjacent to tile_idxs from offset_cache if every tile they are adjacent to
+    is done. Tiles outside the grid count as done, since they are never visited.
+    """
+    w, h = done.shape
+    is_done = lambda x, y: x < 0 or y < 0 or x >= w or y >= h or done[x, y]
+    for tile_x, tile_y in tile_idxs:
+        for grid_key, dx, dy in ADJACENT_OFFSETS.values():
+            x, y = tile_x + dx, tile_y + dy
+            if (x, y) not in offset_cache[grid_key]:
+                continue
+            # An offset tile is adjacent to the tiles at the same index, and one further along
+            # each axis it is offset on (the inverse of ADJACENT_OFFSETS)
+            gx, gy = grid_key
+            adjacent = itertools.product(range(x, x + gx + 1), range(y, y + gy + 1))
+            if all(is_done(ax, ay) for ax, ay in adjacent):
+                del offset_cache[grid_key][(x, y)]
+
+
 @functools.lru_cache(1)
 def _weight_matrices(h, w):
     """Creates a grid sized (h, w) of weights to apply to corners/edges of adjacent tiles"""
@@ -639,9 +809,13 @@ def _weight_matrices(h, w):
     return result
 
 
-def average_logits_towards_edges(logits, adjacent):
-
-    c, h, w = logits.shape
+@functools.lru_cache(1)
+def _adjacent_weight_blocks(h, w):
+    """
+    Slices the weight matrices ahead of time for each adjacent direction.
+    Returns the center weights, and a dict mapping direction to
+    (slice of this tile, slice of the adjacent tile, weights for the slice).
+    """
     h2, w2 = h // 2, w // 2
     weights = _weight_matrices(h, w)
     slices = {
@@ -654,35 +828,63 @@ def average_logits_towards_edges(logits, adjacent):
         "do": (slice(h2, None), slice(None)),
         "br": (slice(h2, None), slice(w2, None)),
     }
+    # e.g. the bottom-left corner of the top-right adjacent tile overlaps the top-right corner
+    opposites = {
+        "tl": "br",
+        "up": "do",
+        "tr": "bl",
+        "le": "ri",
+        "ri": "le",
+        "bl": "tr",
+        "do": "up",
+        "br": "tl",
+    }
+    positions = {
+        "tl": (0, 0),
+        "up": (0, 1),
+        "tr": (0, 2),
+        "le": (1, 0),
+        "ri": (1, 2),
+        "bl": (2, 0),
+        "do": (2, 1),
+        "br": (2, 2),
+    }
+    blocks = {
+        k: (slices[k], slices[opposites[k]], weights[pos][slices[k]])
+        for k, pos in positions.items()
+    }
+    return weights[1, 1], blocks
+
 
-    def f(tile, slc, islc, weight):
-        if tile is None:
-            return 0
-        return tile[:, *islc] * weight[slc]
+def average_logits_towards_edges(logits, adjacent):
+
+    c, h, w = logits.shape
+    center_weights, blocks = _adjacent_weight_blocks(h, w)
 
-    out = np.zeros_like(logits)
+    out = np.multiply(logits, center_weights, out=np.empty_like(logits))
+    tmp = np.empty_like(logits)
 
     # Take the bottom-left corner of the top-right adjacent tile, and multiply by the weights
     # And similarly for the others. Complicated slightly by the fact they may not exist.
-    out[:, *slices["tl"]] += f(adjacent["tl"], slices["tl"], slices["br"], weights[0, 0])
-    out[:, *slices["up"]] += f(adjacent["up"], slices["up"], slices["do"], weights[0, 1])
-    out[:, *slices["tr"]] += f(adjacent["tr"], slices["tr"], slices["bl"], weights[0, 2])
-    out[:, *slices["le"]] += f(adjacent["le"], slices["le"], slices["ri"], weights[1, 0])
-    out += logits * weights[1, 1]
-    out[:, *slices["ri"]] += f(adjacent["ri"], slices["ri"], slices["le"], weights[1, 2])
-    out[:, *slices["bl"]] += f(adjacent["bl"], slices["bl"], slices["tr"], weights[2, 0])
-    out[:, *slices["do"]] += f(adjacent["do"], slices["do"], slices["up"], weights[2, 1])
-    out[:, *slices["br"]] += f(adjacent["br"], slices["br"], slices["tl"], weights[2, 2])
+    for k, (slc, islc, weight) in blocks.items():
+        if adjacent[k] is None:
+            continue
+        tmp_slc = tmp[:, *slc]
+        np.multiply(adjacent[k][:, *islc], weight, out=tmp_slc)
+        out[:, *slc] += tmp_slc
 
     return out
 
 
 def s1_preprocess_edge_heuristic(tensors, threshold=0.05):
     """Uses a heuristic to check if the tensor is not at the edge (i.e. False if at the edge)"""
-    no_nan = np.all([np.isnan(t).sum() == 0 for t in tensors])
-    # The tensors are at the edge if they have a significant proportion of 0s
-    not_too_many_zeros = np.all([(t < 1e-5).sum() < (t.size * threshold) for t in tensors])
-    return no_nan and not_too_many_zeros
+    for t in tensors:
+        if np.isnan(t).any():
+            return False
+        # The tensors are at the edge if they have a significant proportion of 0s
+        if np.count_nonzero(t < 1e-5) >= (t.size * threshold):
+            return False
+    return True
 
 
 def tile_flooded(stats, threshold=0.05):
@@ -698,6 +900,19 @@ def sel_new_tiles_big_window(tile_x, tile_y, xsize, ysize, add=3):
     return list(itertools.product(range(xlo, xhi), range(ylo, yhi)))
 
 
+def queue_new_tiles_big_window(tile_x, tile_y, queued, tiles, add=3):
+    """
+    Appends tiles within the sel_new_tiles_big_window window that haven't been queued yet,
+    in the same order, marking them as queued.
+    """
+    xlo = max(0, tile_x - add)
+    ylo = max(0, tile_y - add)
+    window = queued[xlo : tile_x + add, ylo : tile_y + add]
+    xs, ys = np.nonzero(~window)
+    window[xs, ys] = True
+    tiles.extend(zip((xs + xlo).tolist(), (ys + ylo).tolist()))
+
+
 def load_rivers(hydroatlas_path: Path, threshold: int = 100):
     river_path = hydroatlas_path / "filtered_rivers.gpkg"
     if river_path.exists():
@@ -718,6 +933,100 @@ def load_rivers(hydroatlas_path: Path, threshold: int = 100):
     return rivers_df
 
 
+def _get_dem_tile(geom: shapely.Geometry, size: tuple[int, int], folder: Path, geom_crs: str):
+    geom_4326 = util.convert_crs(geom, geom_crs, "EPSG:4326")
+    try:
+        dem_coarse = data_sources.get_dem(geom_4326, shp_crs="EPSG:4326", folder=folder)
+    except data_sources.URLNotAvailable:
+        return None
+    dem_fine = util.resample_xr(dem_coarse, geom_4326.bounds, size)
+    return dem_fine.band_data.values
+
+
+def _load_dem_tiles(
+    geoms: list[shapely.Geometry], size: tuple[int, int], folder: Path, geom_crs: str
+):
+    return [_get_dem_tile(geom, size, folder, geom_crs) for geom in geoms]
+
+
+def _to_device(inps: list[np.ndarray], device: str):
+    """Asynchronous if inps are in pinned memory (see util.load_tiles_batched)"""
+    return tuple(torch.from_numpy(inp).to(device, non_blocking=True) for inp in inps)
+
+
+def _forward(model: torch.nn.Module, device: str, *args, **kwargs):
+    """
+    Runs model without autograd, and in mixed precision on the GPU if enabled (see
+    set_mixed_precision). Returns the outputs as a float32 numpy array.
+    """
+    # Without the cache, so the casts are also captured by CUDAGraphModel
+    enabled = mixed_precision and device == "cuda"
+    amp = torch.autocast(device, dtype=torch.float16, enabled=enabled, cache_enabled=False)
+    with torch.inference_mode(), amp:
+        # Not copied into pinned memory: the logits are kept in offset_cache, which would keep
+        # whole pinned batches alive, and the copy has to be waited on straight away anyway
+        return model(*args, **kwargs).float().cpu().numpy()
+
+
+def _infer_flood_vit(inps: list[np.ndarray], model: torch.nn.Module):
+    return _forward(model, "cuda", _to_device(inps, "cuda"))
+
+
+def _infer_with_dems(inps: list[np.ndarray], dems: list[np.ndarray], infer: callable):
+    """
+    Runs infer(valid_inps, dem) on only the tiles where the DEM is available.
+    Logits are None for any tile where the DEM is not available.
+    """
+    outs = [None] * len(dems)
+    valid = [i for i, dem in enumerate(dems) if dem is not None]
+    if len(valid) > 0:
+        if len(valid) < len(dems):
+            # Note: indexing copies the inputs out of pinned memory
+            inps = [inp[valid] for inp in inps]
+        valid_inps = _to_device(inps, "cuda")
+        dem_np = np.concatenate([dems[i] for i in valid])
+        for i, out in zip(valid, infer(valid_inps, dem_np)):
+            outs[i] = out
+    return outs
+
+
+def _infer_snunet(inps: list[np.ndarray], dems: list[np.ndarray], model: torch.nn.Module):
+    return _infer_with_dems(
+        inps, dems, lambda valid_inps, dem: _forward(model, "cuda", valid_inps, dem=dem)
+    )
+
+
+def _infer_flood_vit_and_snunet(
+    inps: list[np.ndarray],
+    dems: list[np.ndarray],
+    vit_model: torch.nn.Module,
+    snunet_model: torch.nn.Module,
+):
+    def infer(valid_inps, dem):
+        vit_out = _forward(vit_model, "cuda", valid_inps)
+        snunet_out = _forward(snunet_model, "cuda", valid_inps[-2:], dem=dem)
+        return (vit_out + snunet_out) / 2
+
+    return _infer_with_dems(inps, dems, infer)
+
+
+def run_snunet_batched(
+    imgs,
+    geoms: list[shapely.Geometry],
+    model: torch.nn.Module,
+    folder: Path,
+    geoms_in_px: bool = False,
+    geom_crs: str = "EPSG:3857",
+):
+    """
+    Runs snunet on all geoms in a single batch.
+    Logits are None for any geom where the DEM is not available.
+    """
+    inps = util.load_tiles_batched(imgs, geoms, geoms_in_px)
+    dems = _load_dem_tiles(geoms, inps[0].shape[2:], folder, geom_crs)
+    return inps, dems, _infer_snunet(inps, dems, model)
+
+
 def run_snunet_once(
     imgs,
     geom: shapely.Geometry,
@@ -726,25 +1035,40 @@ def run_snunet_once(
     geom_in_px: bool = False,
     geom_crs: str = "EPSG:3857",
 ):
-    inps = util.get_tiles_single(imgs, geom, geom_in_px)
+    inps, dems, outs = run_snunet_batched(imgs, [geom], model, folder, geom_in_px, geom_crs)
+    return inps, dems[0], outs[0]
 
-    geom_4326 = util.convert_crs(geom, geom_crs, "EPSG:4326")
-    try:
-        dem_coarse = data_sources.get_dem(geom_4326, shp_crs="EPSG:4326", folder=folder)
-    except data_sources.URLNotAvailable:
-        return inps, None, None
-    dem_fine = util.resample_xr(dem_coarse, geom_4326.bounds, inps[0].shape[2:])
-    dem_np = dem_fine.band_data.values
-    out = model(tuple(inps), dem=dem_np)[0].cpu().numpy()
-    return inps, dem_np, out
+
+def run_flood_vit_batched(
+    imgs, geoms: list[shapely.Geometry], model: torch.nn.Module, geoms_in_px: bool = False
+):
+    inps = util.load_tiles_batched(imgs, geoms, geoms_in_px)
+    return inps, None, _infer_flood_vit(inps, model)
 
 
 def run_flood_vit_once(
     imgs, geom: shapely.Geometry, model: torch.nn.Module, geom_in_px: bool = False
 ):
-    inps = util.get_tiles_single(imgs, geom, geom_in_px)
-    out = model(tuple(inps))[0].cpu().numpy()
-    return inps, None, out
+    inps, _, outs = run_flood_vit_batched(imgs, [geom], model, geom_in_px)
+    return inps, None, outs[0]
+
+
+def run_flood_vit_and_snunet_batched(
+    imgs,
+    geoms: list[shapely.Geometry],
+    vit_model: torch.nn.Module,
+    snunet_model: torch.nn.Module,
+    folder: Path,
+    geoms_in_px: bool = False,
+    geom_crs: str = "EPSG:3857",
+):
+    """
+    Runs both models on all geoms in a single batch and averages their logits.
+    Logits are None for any geom where the DEM is not available.
+    """
+    inps = util.load_tiles_batched(imgs, geoms, geoms_in_px)
+    dems = _load_dem_tiles(geoms, inps[0].shape[2:], folder, geom_crs)
+    return inps, dems, _infer_flood_vit_and_snunet(inps, dems, vit_model, snunet_model)
 
 
 def run_flood_vit_and_snunet_once(
@@ -756,64 +1080,156 @@ def run_flood_vit_and_snunet_once(
     geom_in_px: bool = False,
     geom_crs: str = "EPSG:3857",
 ):
-    inps = util.get_tiles_single(imgs, geom, geom_in_px)
+    inps, dems, outs = run_flood_vit_and_snunet_batched(
+        imgs, [geom], vit_model, snunet_model, folder, geom_in_px, geom_crs
+    )
+    return inps, dems[0], outs[0]
 
-    geom_4326 = util.convert_crs(geom, geom_crs, "EPSG:4326")
-    try:
-        dem_coarse = data_sources.get_dem(geom_4326, shp_crs="EPSG:4326", folder=folder)
-    except data_sources.URLNotAvailable:
-        return inps, None, None
-    dem_fine = util.resample_xr(dem_coarse, geom_4326.bounds, inps[0].shape[2:])
-    dem_th = dem_fine.band_data.values
-    vit_out = vit_model(tuple(inps))[0].cpu().numpy()
-    snunet_out = snunet_model(tuple(inps[-2:]), dem=dem_th)[0].cpu().numpy()
-    out = (vit_out + snunet_out) / 2
-    return inps, dem_th, out
 
+class FloodModelRunner:
+    """
+    Runs a flood model on a batch of tiles in two stages, so that loading the inputs
+    (disk/network bound) can happen in another thread while the model runs (GPU bound).
 
-def run_flood_vit_batched(
-    imgs, geoms: np.ndarray, model: torch.nn.Module, geoms_in_px: bool = False
-):
-    inps = util.get_tiles_batched(imgs, geoms, geoms_in_px)
-    out = model(inps).cpu().numpy()
-    return inps, None, out
+    load(tifs, geoms) -> (inps, dems); infer(inps, dems) -> (inps, dems, logits)
+    Calling the runner directly runs both stages.
+    """
+
+    def __init__(self, load: callable, infer: callable):
+        self.load = load
+        self.infer = infer
+
+    def __call__(self, tifs, geoms):
+        return self.infer(*self.load(tifs, geoms))
 
 
 def vit_decoder_runner():
-    run_flood_model = lambda tifs, geom: run_flood_vit_once(tifs, geom, vit_model)
-    return run_flood_model
+    load = lambda tifs, geoms: (util.load_tiles_batched(tifs, geoms, pin_memory=True), None)
+    infer = lambda inps, dems: (inps, dems, _infer_flood_vit(inps, vit_model))
+    return FloodModelRunner(load, infer)
 
 
 def snunet_runner(crs, folder):
-    run_flood_model = lambda tifs, geom: run_snunet_once(
-        tifs[-2:], geom, snunet_model, folder, geom_crs=crs
-    )
-    return run_flood_model
+    def load(tifs, geoms):
+        inps = util.load_tiles_batched(tifs[-2:], geoms, pin_memory=True)
+        return inps, _load_dem_tiles(geoms, inps[0].shape[2:], folder, crs)
+
+    infer = lambda inps, dems: (inps, dems, _infer_snunet(inps, dems, snunet_model))
+    return FloodModelRunner(load, infer)
 
 
 def average_vit_snunet_runner(crs, folder):
-    run_flood_model = lambda tifs, geom: run_flood_vit_and_snunet_once(
-        tifs, geom, vit_model, snunet_model, folder, geom_crs=crs
+    def load(tifs, geoms):
+        inps = util.load_tiles_batched(tifs, geoms, pin_memory=True)
+        return inps, _load_dem_tiles(geoms, inps[0].shape[2:], folder, crs)
+
+    infer = lambda inps, dems: (
+        inps,
+        dems,
+        _infer_flood_vit_and_snunet(inps, dems, vit_model, snunet_model),
     )
-    return run_flood_model
+    return FloodModelRunner(load, infer)
 
 
 vit_model = None
 snunet_model = None
+mixed_precision = False
+
+
+def set_mixed_precision(enabled: bool):
+    """
+    Runs the flood models in FP16 autocast, with TF32 matmuls for anything autocast leaves in
+    FP32. This changes the logits slightly, see scripts/check-mixed-precision.py
+    (Convolutions already use TF32 by default, as torch.backends.cudnn.allow_tf32 is True)
+    """
+    global mixed_precision
+    mixed_precision = enabled
+    torch.set_float32_matmul_precision("high" if enabled else "highest")
+
+
+class CUDAGraphModel:
+    """
+    Captures a CUDA graph of model for each distinct input shape (i.e. batch size), then replays
+    it for later inputs of that shape, instead of launching every kernel separately.
+
+    Only for models taking a tuple of GPU tensors. The output is only valid until the next call.
+    All graphs share one memory pool, so the activations aren't kept once per batch size. That's
+    only safe because each output is consumed before the next replay of any graph, which may
+    overwrite it.
+    """
+
+    def __init__(self, model: torch.nn.Module):
+        self.model = model
+        self.graphs = {}
+        self.pool = torch.cuda.graph_pool_handle()
+
+    def _capture(self, inps: tuple[torch.Tensor]):
+        static_inps = tuple(inp.clone() for inp in inps)
+        # Warm up on a side stream, so lazy initialisation doesn't end up in the graph
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self.model(static_inps)
+        torch.cuda.current_stream().wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        # The prefetch thread keeps allocating pinned memory during capture, which global mode
+        # would count as a prohibited call
+        with torch.cuda.graph(graph, pool=self.pool, capture_error_mode="thread_local"):
+            static_out = self.model(static_inps)
+        return graph, static_inps, static_out
+
+    def __call__(self, inps: tuple[torch.Tensor]):
+        key = tuple(inp.shape for inp in inps)
+        if key not in self.graphs:
+            self.graphs[key] = self._capture(inps)
+        graph, static_inps, static_out = self.graphs[key]
+        for static_inp, inp in zip(static_inps, inps):
+            static_inp.copy_(inp, non_blocking=True)
+        graph.replay()
+        return static_out
+
+
+def _compile_flood_model(model: torch.nn.Module):
+    """
+    Compiles with inductor by default.
+    With COMPILE_BACKEND=tensorrt, builds TensorRT engines instead (requires torch_tensorrt).
+    """
+    # Each batch size (up to batch_size, plus the neighbour batches) is compiled separately,
+    # which would otherwise hit the default recompile limit and fall back to eager
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+    backend = os.environ.get("COMPILE_BACKEND", "inductor").lower()
+    if backend == "tensorrt":
+        import torch_tensorrt  # Registers the "tensorrt" backend with torch.compile
+
+        # FP16 lets TensorRT use tensor cores, keeping FP32 wherever that's more accurate
+        options = {"enabled_precisions": {torch.float16, torch.float32}}
+        return torch.compile(model.eval(), backend="tensorrt", dynamic=False, options=options)
+    return torch.compile(model, mode="reduce-overhead", dynamic=False)
 
 
 def model_runner(name: str, data_folder: Path):
     global vit_model
     global snunet_model
 
+    set_mixed_precision(os.environ.get("MIXED_PRECISION", "no")[0].lower() == "y")
+    # Tiles are always the same size, so the compiled graph can be specialised to the shape
+    # Note: each distinct batch size (at most batch_size of them) is compiled separately
+    compile_models = os.environ.get("COMPILE_MODELS", "no")[0].lower() == "y"
+    # torch.compile's default backend (mode="reduce-overhead") already uses CUDA graphs
+    cuda_graphs = os.environ.get("CUDA_GRAPHS", "no")[0].lower() == "y" and not compile_models
     if "vit" in name and vit_model is None:
-        vit_model = torch.hub.load("Multihuntr/KuroSiwo", "vit_decoder", pretrained=True).cuda()
-        if os.environ.get("CACHE_MODEL_OUTPUTS", "no")[0].lower() == "y":
-            vit_model = util.np_cache(maxsize=3000)(vit_model)
+        vit_model = torch.hub.load("Multihuntr/KuroSiwo", "vit_decoder", pretrained=True)
+        vit_model = vit_model.cuda().eval()
+        if compile_models:
+            vit_model = _compile_flood_model(vit_model)
+        elif cuda_graphs:
+            vit_model = CUDAGraphModel(vit_model)
     if "snunet" in name and snunet_model is None:
-        snunet_model = torch.hub.load("Multihuntr/KuroSiwo", "snunet", pretrained=True).cuda()
-        if os.environ.get("CACHE_MODEL_OUTPUTS", "no")[0].lower() == "y":
-            snunet_model = util.np_cache(maxsize=3000)(snunet_model)
+        snunet_model = torch.hub.load("Multihuntr/KuroSiwo", "snunet", pretrained=True)
+        snunet_model = snunet_model.cuda().eval()
+        if compile_models:
+            snunet_model = _compile_flood_model(snunet_model)
 
     if name == "vit":
         run_flood_model = vit_decoder_runner()
@@ -841,44 +1257,92 @@ def postprocess_classes(in_fpath, out_fpath, **kwargs):
         out_tif.write(floodmaps)
 
 
+def floodmap_to_cog(meta_path: Path):
+    """
+    Rewrites a floodmap as a COG, with blocks the size of a tile, so windowed reads are cheap.
+    Must be the last step: GDAL refuses to open a COG with "r+", and would not update the
+    overviews anyway. So run this after remove_tiles_outside and postprocess_world_cover.
+    """
+    with meta_path.open() as f:
+        meta = json.load(f)
+
+    fpath = meta_path.parent / meta["floodmap"]
+    cog_fpath = fpath.with_name(fpath.stem + "-cog.tif")
+    with rasterio.open(fpath) as tif:
+        rasterio.shutil.copy(
+            tif,
+            cog_fpath,
+            driver="COG",
+            BLOCKSIZE=tif.profile["blockxsize"],
+            COMPRESS="ZSTD",
+            LEVEL=constants.FLOODMAP_PROFILE_DEFAULTS["ZSTD_LEVEL"],
+            PREDICTOR="STANDARD",
+            NUM_THREADS="ALL_CPUS",
+            OVERVIEW_RESAMPLING="NEAREST",
+        )
+    cog_fpath.replace(fpath)
+
+
+_POSTPROCESS_KERNEL = skimage.morphology.disk(radius=2)
+_BORDER_FOOTPRINT = scipy.ndimage.generate_binary_structure(2, 1)
+
+
 def _postprocess_classes(class_map, mask=None, size_threshold=50):
     # Smooth edges
-    kernel = skimage.morphology.disk(radius=2)
-    smoothed = skimage.filters.rank.majority(class_map, kernel, mask=mask)
+    # Only within the bounding box of the mask, padded by the kernel radius, since rank.majority
+    # also fills pixels outside the mask that are within reach of it. Beyond that, it's all 0.
+    if mask is None:
+        smoothed = skimage.filters.rank.majority(class_map, _POSTPROCESS_KERNEL)
+    else:
+        ys, xs = np.nonzero(mask.any(axis=1))[0], np.nonzero(mask.any(axis=0))[0]
+        smoothed = np.zeros_like(class_map)
+        if ys.size == 0:
+            return smoothed
+        r = _POSTPROCESS_KERNEL.shape[0] // 2
+        crop = np.s_[max(ys[0] - r, 0) : ys[-1] + r + 1, max(xs[0] - r, 0) : xs[-1] + r + 1]
+        smoothed[crop] = skimage.filters.rank.majority(
+            class_map[crop], _POSTPROCESS_KERNEL, mask=mask[crop]
+        )
 
     # Remove "small" holes in non-background classes
-    h, w = smoothed.shape
+    # i.e. small connected regions either of the class, or within the class.
+    # Each is filled with the majority class of the pixels bordering it.
+    present = np.unique(smoothed)
     for cls_id in range(1, 3):
-        for shp_np in skimage.measure.find_contours(smoothed == cls_id):
-            if np.linalg.norm(shp_np[0] - shp_np[-1]) > 2:
-                # This happens if the contour does not form a polygon
-                # (e.g. cutting off a corner of the image)
+        if cls_id not in present:
+            continue
+        for inside in (True, False):
+            labels, n_labels = scipy.ndimage.label((smoothed == cls_id) == inside)
+            small = np.bincount(labels.ravel()) < size_threshold
+            small[0] = False
+            # Regions cut off by the edge of the image may continue outside it
+            edges = (labels[0], labels[-1], labels[:, 0], labels[:, -1])
+            small[np.concatenate(edges)] = False
+            if not small.any():
                 continue
-            elif len(shp_np) <= 2:
-                # This happens when there's a single pixel
-                # Note: skimage contours places coordinates at half-pixels
-                y, x = np.round(shp_np.mean(axis=0)).astype(np.int32)
-                ylo, xlo = max(0, y - 2), max(0, x - 2)
-                yhi, xhi = min(h, y + 3), min(w, x + 3)
-                slices = (slice(ylo, yhi), slice(xlo, xhi))
-                majority, _ = scipy.stats.mode(smoothed[slices], axis=None)
-                smoothed[y, x] = majority
-            else:
-                shp = shapely.Polygon(shp_np)
-                if shp.area < size_threshold:
-                    ylo, xlo, yhi, xhi = util.rounded_bounds(shp.bounds)
-                    ylo, xlo = max(0, ylo - 2), max(0, xlo - 2)
-                    yhi, xhi = min(h, yhi + 3), min(w, xhi + 3)
-                    slices = (slice(ylo, yhi), slice(xlo, xhi))
-                    shp_mask = skimage.draw.polygon2mask(
-                        (yhi - ylo, xhi - xlo), shp_np - (ylo, xlo)
-                    )
-                    majority, _ = scipy.stats.mode(smoothed[slices], axis=None)
-                    smoothed[slices][shp_mask] = majority
+
+            # Label the pixels bordering each small region, and count their classes
+            small_labels = np.where(small[labels], labels, 0)
+            grown = scipy.ndimage.grey_dilation(small_labels, footprint=_BORDER_FOOTPRINT)
+            border = (grown != 0) & (small_labels == 0)
+            border_idxs = grown[border] * 3 + smoothed[border]
+            counts = np.bincount(border_idxs, minlength=(n_labels + 1) * 3)
+            majority = counts.reshape(n_labels + 1, 3).argmax(axis=1).astype(smoothed.dtype)
+
+            fill = small_labels != 0
+            smoothed[fill] = majority[small_labels[fill]]
 
     return smoothed
 
 
+# The same basins_df is used for every ROI, so only build the lookup once
+@util.cache_by_id
+def _basin_index(basins_df):
+    """Returns ({HYBAS_ID: row index}, basin geometries as an np.ndarray)"""
+    hybas_idxs = {hybas_id: i for i, hybas_id in enumerate(basins_df.HYBAS_ID.values.tolist())}
+    return hybas_idxs, np.array(basins_df.geometry.values)
+
+
 def postprocess_world_cover(data_folder, meta_fpath, basins_df, basins_geom):
     """
     Pastes world cover in the ocean tiles.
@@ -887,27 +1351,25 @@ def postprocess_world_cover(data_folder, meta_fpath, basins_df, basins_geom):
     with open(meta_fpath) as f:
         meta = json.load(f)
 
-    basin_idx = basins_df.HYBAS_ID.values.tolist().index(meta["HYBAS_ID_4"])
-    basin_geoms = np.array(basins_df.geometry.values)
+    hybas_idxs, basin_geoms = _basin_index(basins_df)
 
     # Create ocean shp - expand lvl4 basin, subtract all basins
-    basin_geom = basin_geoms[basin_idx]
+    basin_geom = basin_geoms[hybas_idxs[meta["HYBAS_ID_4"]]]
     # NOTE: Magic numbers coupled with util.majority_tile_mask_for_basin
     including_ocean = shapely.buffer(basin_geom, 0.04).simplify(0.01)
     ocean_shp = shapely.difference(including_ocean, basins_geom)
 
     # Check which tiles are in the ocean
     tile_fpath = meta_fpath.parent / meta["visit_tiles"]
-    tiles = geopandas.read_file(tile_fpath, engine="pyogrio", use_arrow=True)
-    tile_geoms = np.array(tiles.geometry.values)[:, None]
-    ocean_mask = shapely.intersects(tile_geoms, ocean_shp)
-    ocean_tiles = tiles[ocean_mask]
+    # Only the geometries are needed, so don't read (or convert) any attribute columns
+    tiles = geopandas.read_file(tile_fpath, engine="pyogrio", use_arrow=True, columns=[])
+    tile_geoms = np.array(tiles.geometry.values)
+    ocean_geoms = tile_geoms[grid_intersecting(tile_geoms, ocean_shp)]
 
     floodmap_fpath = meta_fpath.parent / meta["floodmap"]
     with rasterio.open(floodmap_fpath, "r+") as tif:
-        for i, tile in ocean_tiles.iterrows():
+        for geom in ocean_geoms:
             # Get pixel bounds
-            geom = tile.geometry
             window = util.shapely_bounds_to_rasterio_window(geom.bounds, tif.transform, align=True)
             (ylo, yhi), (xlo, xhi) = window
             data = tif.read(window=window)
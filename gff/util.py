@@ -189,6 +189,23 @@ def resample_bilinear_subpixel(arr, bounds):
     return out
 
 
+def cache_by_id(fn):
+    """
+    Like functools.cache, but keyed on the id of the first argument (e.g. an unhashable DataFrame).
+    Keeps a reference to that argument, so that its id can't be reused.
+    """
+    cache = {}
+
+    @functools.wraps(fn)
+    def wrapper(obj, *args):
+        key = (id(obj), *args)
+        if key not in cache:
+            cache[key] = (obj, fn(obj, *args))
+        return cache[key][1]
+
+    return wrapper
+
+
 @functools.cache
 def tif_data_ram(fpath: Path):
     memfile = rasterio.MemoryFile()
@@ -255,16 +272,31 @@ def get_tiles_single(imgs, geom: shapely.Geometry, geom_in_px: bool = False):
     return inps
 
 
-def get_tiles_batched(imgs, geoms: shapely.Geometry, geom_in_px: bool = False):
-    """Get windows from a list of images for a batched model run"""
+def load_tiles_batched(
+    imgs, geoms: shapely.Geometry, geom_in_px: bool = False, pin_memory: bool = False
+):
+    """
+    Get windows from a list of images for a batched model run, as numpy arrays on the CPU.
+    If pin_memory, the arrays are backed by page-locked memory, so they can be copied to the
+    GPU asynchronously (with non_blocking=True).
+    """
     inps = []
     for p in imgs:
         img_windows = [get_tile(p, geom.bounds, bounds_in_px=geom_in_px) for geom in geoms]
-        img_batch = np.stack(img_windows)
-        inps.append(torch.tensor(img_batch).cuda())
+        out = None
+        if pin_memory:
+            dtype = torch.from_numpy(img_windows[0]).dtype
+            shape = (len(img_windows), *img_windows[0].shape)
+            out = torch.empty(shape, dtype=dtype, pin_memory=True).numpy()
+        inps.append(np.stack(img_windows, out=out))
     return inps
 
 
+def get_tiles_batched(imgs, geoms: shapely.Geometry, geom_in_px: bool = False):
+    """Get windows from a list of images for a batched model run"""
+    return [torch.tensor(inp).cuda() for inp in load_tiles_batched(imgs, geoms, geom_in_px)]
+
+
 # Basin utilities
 
 
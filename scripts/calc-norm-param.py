@@ -1,4 +1,5 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import json
 from pathlib import Path
 import sys
@@ -22,32 +23,65 @@ def parse_args(argv):
     )
 
     parser.add_argument("data_path", type=Path)
+    parser.add_argument(
+        "--n_workers", type=int, default=8, help="how many threads to read S1/DEM tiles with"
+    )
 
     return parser.parse_args(argv)
 
 
+def empty_stats(n_bands):
+    """Running (count, mean, M2) per band, for Welford's/Chan's algorithm"""
+    return np.zeros(n_bands, dtype=np.int64), np.zeros(n_bands), np.zeros(n_bands)
+
+
+def batch_stats(data, valid):
+    """
+    (count, mean, M2) per band of the valid values in data, both shaped (bands, N)
+    Works in place if data is already float64, so data is overwritten.
+    """
+    n = valid.sum(axis=1)
+    data = data.astype(np.float64, copy=False)
+    np.putmask(data, ~valid, 0)
+    mean = np.divide(data.sum(axis=1), n, out=np.zeros(len(n)), where=n > 0)
+    data -= mean[:, None]
+    np.putmask(data, ~valid, 0)
+    return n, mean, np.einsum("cn,cn->c", data, data)
+
+
+def combine_stats(stats, batch):
+    """Chan et al.'s parallel update, combining running stats with the stats of a batch"""
+    n, mean, m2 = stats
+    batch_n, batch_mean, batch_m2 = batch
+    total = n + batch_n
+    frac = np.divide(batch_n, total, out=np.zeros(len(total)), where=total > 0)
+    delta = batch_mean - mean
+    return total, mean + delta * frac, m2 + batch_m2 + delta**2 * n * frac
+
+
+def finalise_stats(stats):
+    n, mean, m2 = stats
+    return mean, np.sqrt(m2 / n)
+
+
 def get_stats_era5(fpaths, desc, bands):
     n_bands = len(bands)
-    _sum = np.zeros(n_bands, dtype=np.float64)
-    sum_sqr = np.zeros(n_bands, dtype=np.float128)
-    count = 0
+    stats = empty_stats(n_bands)
     for fpath in tqdm.tqdm(fpaths, desc=desc):
         with rasterio.open(fpath) as tif:
             scales = np.array(tif.scales)[:, None, None]
             offsets = np.array(tif.offsets)[:, None, None]
             for idx, window in tqdm.tqdm(list(tif.block_windows(1)), leave=False, desc=fpath.name):
                 data = tif.read(window=window)
-                data = data * scales + offsets
-                data = einops.rearrange(data, "(n c) h w -> n c h w", c=n_bands)
-                nan_mask = data == tif.nodata
-                data[nan_mask] = 0
-                _sum += data.sum(axis=(0, 2, 3))
-                sum_sqr += (data**2).sum(axis=(0, 2, 3))
-                # TODO: Check that locations where one property is null, all are null
-                count += (~np.any(nan_mask, axis=1)).sum().item()
-    mean = _sum / count
-    std = np.sqrt(sum_sqr / count - mean**2)
-    return mean, std
+                valid = data != tif.nodata
+                # Scale in place, rather than allocating a new array for each operation
+                data = data.astype(np.float64)
+                np.multiply(data, scales, out=data)
+                np.add(data, offsets, out=data)
+                data = einops.rearrange(data, "(n c) h w -> c (n h w)", c=n_bands)
+                valid = einops.rearrange(valid, "(n c) h w -> c (n h w)", c=n_bands)
+                stats = combine_stats(stats, batch_stats(data, valid))
+    return finalise_stats(stats)
 
 
 def get_stats_hydroatlas(fpath, ignore_bands):
@@ -59,50 +93,58 @@ def get_stats_hydroatlas(fpath, ignore_bands):
                 ignore_idxs.append(i)
 
         n_bands = len(tif.descriptions)
-        _sum = np.zeros(n_bands, dtype=np.float64)
-        sum_sqr = np.zeros(n_bands, dtype=np.longdouble)
-        count = 0
-
+        stats = empty_stats(n_bands)
         for idx, window in tqdm.tqdm(list(tif.block_windows(1)), leave=False, desc=fpath.name):
-            data = tif.read(window=window)
-            _sum += np.nansum(data, axis=(1, 2))
-            sum_sqr += np.nansum(data**2, axis=(1, 2))
-            # TODO: Check that locations where one property is null, all are null
-            count += np.any((data != tif.nodata), axis=0).sum().item()
-
-    mean = _sum / count
-    std = np.sqrt(sum_sqr / count - mean**2)
+            data = tif.read(window=window, out_dtype=np.float64).reshape(n_bands, -1)
+            valid = data != tif.nodata
+            valid &= ~np.isnan(data)
+            stats = combine_stats(stats, batch_stats(data, valid))
+
+    mean, std = finalise_stats(stats)
     mean[ignore_idxs] = 0
     std[ignore_idxs] = 1
     return mean, std, band_names
 
 
-def get_stats_s1_dem(folder: Path):
+def get_stats_tiles(s1_path, dem_path, hand_path, tile_geoms):
+    """Combined stats over the tiles for S1, DEM and HAND, opening the tifs itself"""
+    s1_stats, dem_stats, hand_stats = empty_stats(2), empty_stats(1), empty_stats(1)
+    with (
+        rasterio.open(s1_path) as s1_tif,
+        rasterio.open(dem_path) as dem_tif,
+        rasterio.open(hand_path) as hand_tif,
+    ):
+        for geom in tile_geoms:
+            s1_data = gff.util.get_tile(s1_tif, geom.bounds, align=True)
+            s1_data = s1_data.reshape(len(s1_data), -1)
+            if np.isnan(s1_data).any():
+                raise Exception("S1 has nan. That shouldn't happen")
+            s1_batch = batch_stats(s1_data, np.ones(s1_data.shape, dtype=bool))
+            s1_stats = combine_stats(s1_stats, s1_batch)
+
+            dem = gff.util.get_tile(dem_tif, geom.bounds, align=True).reshape(1, -1)
+            dem_stats = combine_stats(dem_stats, batch_stats(dem, ~np.isnan(dem)))
+
+            hand = gff.util.get_tile(hand_tif, geom.bounds, align=True).reshape(1, -1)
+            hand_stats = combine_stats(hand_stats, batch_stats(hand, ~np.isnan(hand)))
+    return s1_stats, dem_stats, hand_stats
+
+
+def get_stats_s1_dem(folder: Path, n_workers: int = 8):
     n_bands = 2
-    s1_sums = []
-    s1_sum_sqrs = []
-    s1_counts = []
-    dem_sums = []
-    dem_sum_sqrs = []
-    dem_counts = []
-    hand_sums = []
-    hand_sum_sqrs = []
-    hand_counts = []
+    s1_stats = []
+    dem_stats = []
+    hand_stats = []
     test_fnames = []
     for i in range(gff.constants.N_PARTITIONS):
-        s1_sums.append(np.zeros(n_bands, dtype=np.float64))
-        s1_sum_sqrs.append(np.zeros(n_bands, dtype=np.float128))
-        s1_counts.append(np.zeros(1, dtype=np.int64))
-        dem_sums.append(np.zeros(1, dtype=np.float64))
-        dem_sum_sqrs.append(np.zeros(1, dtype=np.float128))
-        dem_counts.append(np.zeros(1, dtype=np.int64))
-        hand_sums.append(np.zeros(1, dtype=np.float64))
-        hand_sum_sqrs.append(np.zeros(1, dtype=np.float128))
-        hand_counts.append(np.zeros(1, dtype=np.int64))
+        s1_stats.append(empty_stats(n_bands))
+        dem_stats.append(empty_stats(1))
+        hand_stats.append(empty_stats(1))
         fpath = folder / "partitions" / f"floodmap_partition_{i}.txt"
         test_fnames.append(pandas.read_csv(fpath, header=None)[0].values.tolist())
 
     fpaths = list((folder / "rois").glob("*-meta.json"))
+    executor = ThreadPoolExecutor(max_workers=n_workers)
     for j, meta_fpath in enumerate(tqdm.tqdm(fpaths, desc="Files")):
         with open(meta_fpath) as f:
             meta = json.load(f)
@@ -114,59 +156,27 @@ def get_stats_s1_dem(folder: Path):
 
         s1_stem = gff.util.get_s1_stem_from_meta(meta)
         s1_path = meta_fpath.parent / f"{s1_stem}-s1.tif"
-        s1_tif = rasterio.open(s1_path)
         visit_tiles = geopandas.read_file(
-            meta_fpath.parent / meta["visit_tiles"], engine="pyogrio", use_arrow=True
+            meta_fpath.parent / meta["visit_tiles"], engine="pyogrio", use_arrow=True, columns=[]
         )
         fmap_path = meta_fpath.parent / Path(meta["floodmap"])
         dem_path = fmap_path.with_name(fmap_path.stem + "-dem-local.tif")
-        dem_tif = rasterio.open(dem_path)
         hand_path = fmap_path.with_name(fmap_path.stem + "-hand.tif")
-        hand_tif = rasterio.open(hand_path)
-        for i, tile_row in tqdm.tqdm(
-            visit_tiles.iterrows(), desc="Tiles", total=len(visit_tiles), leave=False
-        ):
-            s1_data = gff.util.get_tile(s1_tif, tile_row.geometry.bounds, align=True)
-            s1_summed = s1_data.sum(axis=(1, 2))
-            s1_sum_sqred = (s1_data**2).sum(axis=(1, 2))
-            H, W = s1_data[0].shape
-            s1_counted = H * W
-
-            if np.isnan(s1_summed).sum() > 0:
-                raise Exception("S1 has nan. That shouldn't happen")
-
-            dem = gff.util.get_tile(dem_tif, tile_row.geometry.bounds, align=True)
-            dem_summed = np.nansum(dem)
-            dem_sum_sqred = np.nansum(dem**2)
-            dem_counted = (~np.isnan(dem)).sum()
-
-            hand = gff.util.get_tile(hand_tif, tile_row.geometry.bounds, align=True)
-            hand_summed = np.nansum(hand)
-            hand_sum_sqred = np.nansum(hand**2)
-            hand_counted = (~np.isnan(hand)).sum()
 
+        # Tiles are read and reduced in parallel (GDAL releases the GIL), then combined
+        tile_chunks = np.array_split(np.array(visit_tiles.geometry.values), n_workers)
+        paths = (s1_path, dem_path, hand_path)
+        results = executor.map(lambda geoms: get_stats_tiles(*paths, geoms), tile_chunks)
+        for s1_batch, dem_batch, hand_batch in results:
             for idx in incl_partition:
-                s1_sums[idx] += s1_summed
-                s1_sum_sqrs[idx] += s1_sum_sqred
-                s1_counts[idx] += s1_counted
-                dem_sums[idx] += dem_summed
-                dem_sum_sqrs[idx] += dem_sum_sqred
-                dem_counts[idx] += dem_counted
-                hand_sums[idx] += hand_summed
-                hand_sum_sqrs[idx] += hand_sum_sqred
-                hand_counts[idx] += hand_counted
-
-    s1_means, s1_stds = [], []
-    dem_means, dem_stds = [], []
-    hand_means, hand_stds = [], []
-    for i in range(gff.constants.N_PARTITIONS):
-        s1_means.append(s1_sums[i] / s1_counts[i])
-        s1_stds.append(np.sqrt(s1_sum_sqrs[i] / s1_counts[i] - s1_means[i] ** 2))
-        dem_means.append(dem_sums[i] / dem_counts[i])
-        dem_stds.append(np.sqrt(dem_sum_sqrs[i] / dem_counts[i] - dem_means[i] ** 2))
-        hand_means.append(hand_sums[i] / hand_counts[i])
-        hand_stds.append(np.sqrt(hand_sum_sqrs[i] / hand_counts[i] - hand_means[i] ** 2))
-
+                s1_stats[idx] = combine_stats(s1_stats[idx], s1_batch)
+                dem_stats[idx] = combine_stats(dem_stats[idx], dem_batch)
+                hand_stats[idx] = combine_stats(hand_stats[idx], hand_batch)
+
+    executor.shutdown()
+    s1_means, s1_stds = zip(*[finalise_stats(stats) for stats in s1_stats])
+    dem_means, dem_stds = zip(*[finalise_stats(stats) for stats in dem_stats])
+    hand_means, hand_stds = zip(*[finalise_stats(stats) for stats in hand_stats])
     return s1_means, s1_stds, dem_means, dem_stds, hand_means, hand_stds
 
 
@@ -195,7 +205,10 @@ def main(args):
         args.data_path, "hydroatlas_norm.csv", hydroatlas_bands, hydroatlas_mean, hydroatlas_std
     )
 
-    s1_mean, s1_std, dem_mean, dem_std, hand_mean, hand_std = get_stats_s1_dem(args.data_path)
+    with rasterio.Env(GDAL_CACHEMAX=512, GDAL_NUM_THREADS="ALL_CPUS"):
+        s1_mean, s1_std, dem_mean, dem_std, hand_mean, hand_std = get_stats_s1_dem(
+            args.data_path, args.n_workers
+        )
 
     for x in range(gff.constants.N_PARTITIONS):
         gff.normalisation.save(
@@ -0,0 +1,78 @@
+import argparse
+import datetime
+import json
+import os
+from pathlib import Path
+import sys
+
+import geopandas
+import numpy as np
+import rasterio
+import torch
+
+import gff.generate.floodmaps
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        "Checks that the flood model's classes agree with and without MIXED_PRECISION"
+    )
+
+    parser.add_argument("data_path", type=Path, help="GFF Dataset root")
+    parser.add_argument("meta_path", type=Path, help="meta.json of a generated floodmap")
+    parser.add_argument(
+        "--model", type=str, default="vit", choices=["vit", "snunet", "vit+snunet"]
+    )
+    parser.add_argument("--n_tiles", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args(argv)
+
+
+def main(args):
+    with args.meta_path.open() as f:
+        meta = json.load(f)
+
+    # Sample tiles from those visited when the floodmap was generated
+    visit_tiles = geopandas.read_file(
+        args.meta_path.parent / meta["visit_tiles"], engine="pyogrio", use_arrow=True, columns=[]
+    )
+    tile_geoms = np.array(visit_tiles.geometry.values)
+    rng = np.random.default_rng(args.seed)
+    tile_geoms = rng.permutation(tile_geoms)[: args.n_tiles]
+
+    # The same S1 images (see floodmaps.ensure_s1)
+    s1_fpaths = []
+    for k in ["pre2_date", "pre1_date", "post_date"]:
+        d_str = datetime.datetime.fromisoformat(meta[k]).strftime("%Y-%m-%d")
+        s1_fpaths.append(args.data_path / "s1" / f"{meta['key']}-{d_str}.tif")
+
+    # Captured/compiled models wouldn't pick up the change in precision
+    os.environ["COMPILE_MODELS"] = "no"
+    os.environ["CUDA_GRAPHS"] = "no"
+    flood_model = gff.generate.floodmaps.model_runner(args.model, args.data_path)
+
+    tifs = [rasterio.open(p) for p in s1_fpaths]
+    n_pixels, n_agree = 0, 0
+    for i in range(0, len(tile_geoms), args.batch_size):
+        inputs = flood_model.load(tifs, list(tile_geoms[i : i + args.batch_size]))
+        gff.generate.floodmaps.set_mixed_precision(False)
+        _, _, fp32_logits = flood_model.infer(*inputs)
+        gff.generate.floodmaps.set_mixed_precision(True)
+        _, _, amp_logits = flood_model.infer(*inputs)
+        for fp32, amp in zip(fp32_logits, amp_logits):
+            # No logits where the DEM is unavailable
+            if fp32 is None:
+                continue
+            n_pixels += fp32[0].size
+            n_agree += (fp32.argmax(axis=0) == amp.argmax(axis=0)).sum().item()
+    for tif in tifs:
+        tif.close()
+
+    print(f"{n_agree} / {n_pixels} pixels agree ({100 * n_agree / max(n_pixels, 1):.4f}%)")
+
+
+if __name__ == "__main__":
+    torch.set_grad_enabled(False)
+    main(parse_args(sys.argv[1:]))
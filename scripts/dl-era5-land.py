@@ -11,7 +11,7 @@ We have some preferences/considerations:
 3. We have limited disk space.
 4. We looked to NeuralHydrology streamflow models for inspiration, and these are from Google.
 
-Thus, we decided to use `earthengine-api` to export the ERA5-Land files from GEE to a Drive and 
+Thus, we decided to use `earthengine-api` to export the ERA5-Land files from GEE to a Drive and
 then download that file using `google-api-python-client` (which comes with `earthengine-api`).
 This is that script.
 """
@@ -20,6 +20,7 @@ import argparse
 import contextlib
 import functools
 import logging
+import subprocess
 import tempfile
 import threading
 import time
@@ -34,28 +35,35 @@ import numpy as np
 import shapely
 import rasterio
 import rasterio.mask
-import rasterio.merge
 
 import gff.constants
 
-ssl_lock = threading.Lock()
-ram_lock = threading.Lock()
 task_times = []
+# httplib2 (used by googleapiclient) isn't thread-safe, so each thread builds its own client
+thread_local = threading.local()
 
 
-def _export_to_gdrive(img, fname):
-    ssl_lock.acquire()
+def _thread_gservice(gapi_creds):
+    if not hasattr(thread_local, "gservice"):
+        thread_local.gservice = googleapiclient.discovery.build(
+            "drive", "v3", credentials=gapi_creds
+        )
+    return thread_local.gservice
+
+
+def _export_to_gdrive(img, fname, min_wait=5, max_wait=120):
     task = ee.batch.Export.image.toDrive(img, description=fname)
     task.start()
     status = task.status()
-    ssl_lock.release()
     start = time.time()
+    now = start
+    # Poll with exponential backoff; small exports finish quickly, large ones take hours
+    wait = min_wait
     while status["state"] in ["UNSUBMITTED", "PENDING", "READY", "RUNNING"]:
-        time.sleep(20)
+        time.sleep(wait)
+        wait = min(wait * 2, max_wait)
         now = time.time()
-        ssl_lock.acquire()
         status = task.status()
-        ssl_lock.release()
         logging.debug(f'[{fname}] {status["state"]}: Elapsed {int(now-start):10d}s')
     logging.debug(status)
     if status["state"] in ["CANCELLING", "CANCELLED", "FAILED"]:
@@ -73,11 +81,8 @@ def log_timing(fmt):
 
 
 def _get_files(gservice, fname):
-    ssl_lock.acquire()
     response = gservice.files().list(q=f"name contains '{fname}'", spaces="drive").execute()
-    gfiles = response.get("files", [])
-    ssl_lock.release()
-    return gfiles
+    return response.get("files", [])
 
 
 def _download_by_fname(gservice, fname):
@@ -91,7 +96,6 @@ def _download_by_fname(gservice, fname):
     with log_timing("Time to download {time:5.2f}s"):
         for gfile in gfiles:
             # Download a file from Google Drive to temporary file
-            ssl_lock.acquire()
             export_request = gservice.files().get_media(fileId=gfile["id"])
             file_pointer = tempfile.NamedTemporaryFile("w+b")
             downloader = googleapiclient.http.MediaIoBaseDownload(file_pointer, export_request)
@@ -102,7 +106,6 @@ def _download_by_fname(gservice, fname):
 
             # Delete from Google Drive
             gservice.files().delete(fileId=gfile["id"]).execute()
-            ssl_lock.release()
 
             # Add to list of file_pointers to be used elsewhere (don't close yet!)
             file_pointer.seek(0)
@@ -111,49 +114,94 @@ def _download_by_fname(gservice, fname):
     return file_pointers
 
 
+def _quantize_to_16bit(bands, offsets, scales, areamask, nodata=-32767):
+    """
+    Stores (bands - offsets) / scales as int16, with nodata wherever bands is nan or areamask.
+    Works one band at a time, so the only temporary is the size of a single band.
+    """
+    bands_int = np.empty(bands.shape, dtype=np.int16)
+    tmp = np.empty(bands.shape[1:], dtype=np.result_type(bands, offsets, scales))
+    for band, offset, scale, band_int in zip(bands, offsets, scales, bands_int):
+        np.subtract(band, offset, out=tmp)
+        np.divide(tmp, scale, out=tmp)
+        # Casting nans is undefined, but they're overwritten with nodata straight after
+        with np.errstate(invalid="ignore"):
+            np.copyto(band_int, tmp, casting="unsafe")
+        np.putmask(band_int, np.isnan(band) | areamask, nodata)
+    return bands_int
+
+
+def _band_min_max_windows(fpath, windows):
+    """Per-band nanmin and nanmax of the tif at fpath, reading one window at a time"""
+    with rasterio.open(fpath) as tif:
+        band_min = np.full((tif.count, 1, 1), np.nan)
+        band_max = np.full((tif.count, 1, 1), np.nan)
+        for window in windows:
+            data = tif.read(window=window).reshape(tif.count, -1)
+            # fmin/fmax ignore nans (unless everything is nan)
+            band_min = np.fmin(band_min, np.fmin.reduce(data, axis=1)[:, None, None])
+            band_max = np.fmax(band_max, np.fmax.reduce(data, axis=1)[:, None, None])
+    return band_min, band_max
+
+
+def _band_min_max(fpath, windows, n_workers=4):
+    """Per-band nanmin and nanmax of the tif at fpath, with the windows split over threads"""
+    idx_chunks = np.array_split(np.arange(len(windows)), n_workers)
+    chunks = [[windows[i] for i in idxs] for idxs in idx_chunks if len(idxs)]
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        results = list(executor.map(_band_min_max_windows, [fpath] * len(chunks), chunks))
+    band_mins, band_maxs = zip(*results)
+    return np.fmin.reduce(band_mins), np.fmax.reduce(band_maxs)
+
+
 def _reprocess_to_16bit(file_pointers, out_fpath, new_band_names):
-    # Merge tifs into one big one
-    tifs = [rasterio.open(fp) for fp in file_pointers]
-
-    with log_timing("Merging took {time:5.2f}s"):
-        bands, transform = rasterio.merge.merge(tifs, nodata=np.nan)
-
-    out_profile = {
-        **tifs[0].profile,
-        "height": bands.shape[1],
-        "width": bands.shape[2],
-        "transform": transform,
-        "dtype": "int16",
-        "nodata": -32767,
-        "BIGTIFF": "YES",
-        "TILEXSIZE": 48,
-        "TILEYSIZE": 48,
-    }
-    with rasterio.open(out_fpath, "w", **out_profile) as out_f:
-        band_idxs = list(range(1, 1 + tifs[0].count))
-        areamask, _, _ = rasterio.mask.raster_geometry_mask(out_f, SANS_ANTARCTICA)
-
-        # Convert to int16 representation and set nodata
-        with log_timing("Processing took {time:5.2f}s"):
-            bands_int = np.ones(bands.shape, dtype=np.int16) * -32767
-            offsets = np.nanmin(bands, axis=(1, 2), keepdims=True)
-            scales = (np.nanmax(bands, axis=(1, 2), keepdims=True) - offsets) / 2**14
-            nanmask = np.isnan(bands)
-            mask = ~nanmask & ~areamask
-            bands_int[mask] = ((bands - offsets) / scales)[mask].astype(np.int16)
-
-        # Write to new file as int16 with scale/offset
-        out_f.scales = tuple(scales.flatten())
-        out_f.offsets = tuple(offsets.flatten())
-        with log_timing("Writing to disk: {time:5.2f}s"):
-            out_f.write(bands_int, band_idxs)
-
-        # Give each band a proper name - relying on order being preserved throughout
-        new_band_names_flat = [e for img_band_names in new_band_names for e in img_band_names]
-        for band_idx, band_name in enumerate(new_band_names_flat):
-            out_f.set_band_description(band_idx + 1, band_name)
-    for tif in tifs:
-        tif.close()
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        # Merge tifs into one big one, lazily, so that it's only read a block at a time
+        vrt_fpath = Path(tmp_folder) / "merged.vrt"
+        with log_timing("Merging took {time:5.2f}s"):
+            tif_fpaths = [fp.name for fp in file_pointers]
+            subprocess.run(["gdalbuildvrt", "-vrtnodata", "nan", vrt_fpath, *tif_fpaths])
+
+        with rasterio.open(tif_fpaths[0]) as tif:
+            profile = tif.profile
+        with rasterio.open(vrt_fpath) as merged:
+            out_profile = {
+                **profile,
+                "height": merged.height,
+                "width": merged.width,
+                "transform": merged.transform,
+                "dtype": "int16",
+                "nodata": -32767,
+                "BIGTIFF": "YES",
+                "TILEXSIZE": 48,
+                "TILEYSIZE": 48,
+            }
+            with rasterio.open(out_fpath, "w", **out_profile) as out_f:
+                band_idxs = list(range(1, 1 + merged.count))
+                areamask, _, _ = rasterio.mask.raster_geometry_mask(out_f, SANS_ANTARCTICA)
+                windows = [window for _, window in out_f.block_windows(1)]
+
+                # Convert to int16 representation and set nodata
+                with log_timing("Processing took {time:5.2f}s"):
+                    offsets, band_max = _band_min_max(vrt_fpath, windows)
+                    scales = (band_max - offsets) / 2**14
+
+                # Write to new file as int16 with scale/offset, one block at a time
+                out_f.scales = tuple(scales.flatten())
+                out_f.offsets = tuple(offsets.flatten())
+                with log_timing("Writing to disk: {time:5.2f}s"):
+                    for window in windows:
+                        slices = window.toslices()
+                        bands = merged.read(window=window)
+                        block_int = _quantize_to_16bit(bands, offsets, scales, areamask[slices])
+                        out_f.write(block_int, band_idxs, window=window)
+
+                # Give each band a proper name - relying on order being preserved throughout
+                new_band_names_flat = [
+                    e for img_band_names in new_band_names for e in img_band_names
+                ]
+                for band_idx, band_name in enumerate(new_band_names_flat):
+                    out_f.set_band_description(band_idx + 1, band_name)
 
 
 def estimate_remaining_time(n_tasks):
@@ -184,7 +232,9 @@ def get_new_band_names(dataset, prefix, band_names):
     return year_month_band_names
 
 
-def download_locally(year, month, dataset, gservice, local_folder, band_names, prefix):
+def download_locally(year, month, dataset, gapi_creds, local_folder, band_names, prefix):
+    gservice = _thread_gservice(gapi_creds)
+
     # Determine date range
     start_date = f"{year:04d}-{month:02d}"
     fname = f"{prefix}-{start_date}"
@@ -212,9 +262,7 @@ def download_locally(year, month, dataset, gservice, local_folder, band_names, p
     file_pointers = _download_by_fname(gservice, fname)
 
     # Reprocess to 16-bit numbers
-    ram_lock.acquire()
     _reprocess_to_16bit(file_pointers, local_fpath, new_band_names)
-    ram_lock.release()
 
     # Ensure file pointers are closed properly
     for file_pointer in file_pointers:
@@ -257,7 +305,7 @@ MONTH_RANGE = range(1, 13)
 SANS_ANTARCTICA = shapely.polygons([[[-179, 85], [179, 85], [179, -60], [-179, -60]]])
 
 
-def main(args, gservice):
+def main(args, gapi_creds):
     if not (args.not_land):
         band_names = gff.constants.ERA5L_BANDS
         prefix = "era5-land"
@@ -272,7 +320,7 @@ def main(args, gservice):
     _download_locally_partial = functools.partial(
         download_locally,
         dataset=dataset,
-        gservice=gservice,
+        gapi_creds=gapi_creds,
         local_folder=args.folder,
         band_names=band_names,
         prefix=prefix,
@@ -310,10 +358,9 @@ if __name__ == "__main__":
         filename=args.service_account_private_key_path,
         scopes=["https://www.googleapis.com/auth/drive"],
     )
-    gservice = googleapiclient.discovery.build("drive", "v3", credentials=gapi_creds)
 
     # Set up logging
     root = logging.getLogger()
     root.setLevel(logging.INFO)
 
-    main(args, gservice)
+    main(args, gapi_creds)
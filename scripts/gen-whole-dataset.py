@@ -305,6 +305,7 @@ def main(args):
                 )
                 for meta_fpath in vit_meta_fpaths:
                     gff.generate.floodmaps.remove_tiles_outside(meta_fpath, basins04_df)
+                    gff.generate.floodmaps.floodmap_to_cog(meta_fpath)
 
             # Now that vit floodmaps are ensured, generate another model's floodmaps
             # following the tiles generated by vit.
@@ -333,7 +334,13 @@ def main(args):
                     args.data_path, key, name
                 )
                 for meta_fpath in meta_fpaths:
+                    with meta_fpath.open() as f:
+                        meta = json.load(f)
+                    # Already postprocessed (and so a COG, which can't be edited in place)
+                    if "HYBAS_ID_4" in meta:
+                        continue
                     gff.generate.floodmaps.remove_tiles_outside(meta_fpath, basins04_df)
+                    gff.generate.floodmaps.floodmap_to_cog(meta_fpath)
             else:
                 print(f"    {name} floodmaps already exist.")
 
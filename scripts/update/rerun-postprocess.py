@@ -46,6 +46,8 @@ def main(args):
                 args.data_path, fpath, basins_df, basins_geom
             )
 
+            gff.generate.floodmaps.floodmap_to_cog(fpath)
+
 
 if __name__ == "__main__":
     main(parse_args(sys.argv[1:]))